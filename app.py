@@ -1,13 +1,25 @@
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, send_from_directory, Response
 from dotenv import load_dotenv
 import chromadb
-import requests
-import json
+import httpx
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cachetools import TTLCache
+
+from embedding_cache import EmbeddingCache, ResponseCache, context_key, normalize_prompt
+from fastjson import json_dumps, json_loads
+from intent_router import IntentClassifier, refine_query
+from logsetup import get_logger
+from sse import coalesce, iter_sse_lines
+from vector_index import VectorIndex, assemble_context
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = get_logger('nexus.app')
+
 app = Flask(__name__, static_folder='frontend', static_url_path='')
 
 # --- Configuration ---
@@ -18,6 +30,28 @@ PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+# Headers are constant per provider; build them once.
+JSON_HEADERS = {"Content-Type": "application/json"}
+PERPLEXITY_HEADERS = (
+    {"Authorization": f"Bearer {PERPLEXITY_API_KEY}", "Content-Type": "application/json"}
+    if PERPLEXITY_API_KEY else None
+)
+OPENROUTER_HEADERS = (
+    {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
+    if OPENROUTER_API_KEY else None
+)
+
+# Shared HTTP client: HTTP/2 multiplexing plus connection reuse across all
+# upstream calls (one TLS handshake per host instead of one per request).
+HTTP_CLIENT = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+# Worker pool for overlapping independent upstream calls within one turn.
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
 # Model choices
 GENERATION_MODEL = "mistral:latest"  # Ollama model (still used for embeddings-assisted routes if needed)
 EMBEDDING_MODEL = "nomic-embed-text:latest"
@@ -30,6 +64,40 @@ OPENROUTER_FALLBACK_MODEL = "openai/gpt-oss-20b:free"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMA_DB_PATH = os.path.join(SCRIPT_DIR, "chroma_db")
 COLLECTION_NAME = "pdf_embeddings"
+FAISS_INDEX_PATH = os.path.join(SCRIPT_DIR, "faiss_index.bin")
+
+# Hard cap on retained history messages; bounds both memory and the token
+# cost of every upstream prompt that embeds the conversation.
+MAX_HISTORY_MESSAGES = 20
+
+# --- Static prompts (serialized/built once) ---
+ROUTER_SYSTEM_PROMPT = """You are an expert query analysis agent...""" # Truncated for brevity
+
+RETRIEVAL_SYSTEM_PROMPT = """
+You are an expert academic counselor. Your task is to answer student questions based on the provided course catalog context.
+The context contains information about courses, prerequisites, credit hours, and instructors.
+When a student asks a question, you must find the answer within the provided context and present it clearly.
+If the answer is not in the context, state that you don't have enough information and suggest they contact a human advisor.
+Format your response using Markdown for readability (headings, bold, lists, etc.).
+IMPORTANT: Do not include any links in your response. Provide text-only answers.
+"""
+
+CONVERSATION_PERSONA = {"role": "system", "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University. Please use simple Markdown to format your responses where appropriate (e.g., lists, bold text). IMPORTANT: Do not include any links in your response. Provide text-only answers."}
+
+# The router payload never changes apart from the user message, so serialize
+# the scaffolding once and splice in only the user-message bytes per call
+# (the [:-2] strips the closing b']}' of the messages list, re-added below).
+_ROUTER_PAYLOAD_PREFIX = json_dumps({
+    "model": HELPER_MODEL,
+    "stream": False,
+    "format": "json",
+    "messages": [{"role": "system", "content": ROUTER_SYSTEM_PROMPT}],
+})[:-2]
+
+
+def _router_payload_bytes(user_prompt):
+    return b"".join([_ROUTER_PAYLOAD_PREFIX, b",",
+                     json_dumps({"role": "user", "content": user_prompt}), b"]}"])
 
 # --- Chatbot Logic ---
 class Chatbot:
@@ -37,21 +105,43 @@ class Chatbot:
         try:
             self.client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
             self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME)
-            print("Successfully connected to ChromaDB collection.")
-        except Exception as e:
-            print(f"Error connecting to ChromaDB: {e}")
+            logger.info("Successfully connected to ChromaDB collection.")
+        except Exception:
+            logger.warning("Error connecting to ChromaDB", exc_info=True)
             self.collection = None
-        self.chat_history = []
+        self.vector_index = VectorIndex(self.collection, FAISS_INDEX_PATH)
+        # History as parallel ring buffers: O(1) truncation, no per-turn
+        # reallocation of message dicts.
+        self._roles = deque(maxlen=MAX_HISTORY_MESSAGES)
+        self._contents = deque(maxlen=MAX_HISTORY_MESSAGES)
         self.user_profile = {"major": None, "ambition": None}
+        self.embedding_cache = EmbeddingCache()
+        self.response_cache = ResponseCache()
+        self.intent_classifier = IntentClassifier(self._get_ollama_embedding)
+        self._ctx_cache = TTLCache(maxsize=256, ttl=300)
 
     def clear_session(self):
-        self.chat_history = []
+        self._roles.clear()
+        self._contents.clear()
         self.user_profile = {"major": None, "ambition": None}
-        print("Chat session cleared.")
+        logger.info("Chat session cleared.")
+
+    def _append_history(self, user_text, assistant_text):
+        self._roles.append("user")
+        self._contents.append(user_text)
+        self._roles.append("assistant")
+        self._contents.append(assistant_text)
+
+    def _history_messages(self):
+        return [{"role": r, "content": c} for r, c in zip(self._roles, self._contents)]
 
     def process_query(self, query):
-        chat_history_str = self._format_chat_history(self.chat_history)
-        routing_result = self._route_and_refine_query(query, chat_history_str)
+        chat_history_str = self._format_chat_history()
+        # Embed the raw query speculatively while the router decides the
+        # intent; retrieval turns then skip a serial Ollama roundtrip, and
+        # other turns still warm the embedding cache.
+        fut_emb = EXECUTOR.submit(self._get_ollama_embedding, query)
+        routing_result = self._route_and_refine_query(query, chat_history_str, fut_emb)
         intent = routing_result["intent"]
 
         if intent == 'guidance_search':
@@ -62,59 +152,87 @@ class Chatbot:
                 return self._get_news_guidance(query, self.user_profile)
 
         elif intent == 'retrieval':
-            context = self._retrieve_context(routing_result["query"], self.collection)
-            self.retrieval_prompt = """
-You are an expert academic counselor. Your task is to answer student questions based on the provided course catalog context. 
-The context contains information about courses, prerequisites, credit hours, and instructors.
-When a student asks a question, you must find the answer within the provided context and present it clearly.
-If the answer is not in the context, state that you don't have enough information and suggest they contact a human advisor.
-Format your response using Markdown for readability (headings, bold, lists, etc.).
-IMPORTANT: Do not include any links in your response. Provide text-only answers.
-"""
+            target = routing_result["query"]
+            precomputed = fut_emb.result() if target == query else None
+            context = self._retrieve_context(target, self.collection, precomputed)
             user_prompt_with_context = f'Context from university documents:\n---\n{context or "No context was found for this query."}\n---\nBased on the context above, please answer my last question: "{query}" '
-            messages_for_api = [{"role": "system", "content": self.retrieval_prompt}] + self.chat_history + [{"role": "user", "content": user_prompt_with_context}]
-            return self._stream_perplexity_or_openrouter(messages_for_api)
+            messages_for_api = [{"role": "system", "content": RETRIEVAL_SYSTEM_PROMPT}] + self._history_messages() + [{"role": "user", "content": user_prompt_with_context}]
+            return self._stream_perplexity_or_openrouter(
+                messages_for_api,
+                cache_key=ResponseCache.semantic_key(RETRIEVAL_SYSTEM_PROMPT, query, context))
 
         else: # 'conversation'
-            persona_prefix = {"role": "system", "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University. Please use simple Markdown to format your responses where appropriate (e.g., lists, bold text). IMPORTANT: Do not include any links in your response. Provide text-only answers."}
-            messages_for_api = [persona_prefix] + self.chat_history + [{"role": "user", "content": query}]
+            messages_for_api = [CONVERSATION_PERSONA] + self._history_messages() + [{"role": "user", "content": query}]
             return self._stream_ollama_chat_response(GENERATION_MODEL, messages_for_api)
 
     def _get_ollama_embedding(self, prompt):
+        cached = self.embedding_cache.get(prompt)
+        if cached is not None:
+            return cached
         try:
             payload = {"model": EMBEDDING_MODEL, "prompt": prompt}
-            response = requests.post(OLLAMA_EMBED_ENDPOINT, json=payload)
+            response = HTTP_CLIENT.post(OLLAMA_EMBED_ENDPOINT, content=json_dumps(payload),
+                                        headers=JSON_HEADERS)
             response.raise_for_status()
-            return response.json().get("embedding")
-        except requests.exceptions.RequestException as e:
-            print(f"Error getting embedding from Ollama: {e}")
+            embedding = json_loads(response.content).get("embedding")
+            if embedding is None:
+                return None
+            return self.embedding_cache.add(prompt, embedding)
+        except httpx.HTTPError:
+            logger.warning("Error getting embedding from Ollama", exc_info=True)
             return None
 
-    def _stream_perplexity_or_openrouter(self, messages):
+    def _stream_ollama_chat_response(self, model, messages):
+        """Streams a chat response from the local Ollama server."""
+        def generate():
+            payload = {"model": model, "messages": messages, "stream": True}
+            try:
+                with HTTP_CLIENT.stream("POST", OLLAMA_CHAT_ENDPOINT, content=json_dumps(payload), headers=JSON_HEADERS, timeout=120) as resp:
+                    resp.raise_for_status()
+                    for line in iter_sse_lines(resp):
+                        try:
+                            data = json_loads(line)
+                            content = data.get('message', {}).get('content', '')
+                            if content:
+                                yield content
+                        except ValueError:
+                            continue
+            except httpx.HTTPError:
+                logger.warning("Error streaming from Ollama API", exc_info=True)
+                yield "Sorry, I encountered a connection error."
+        return Response(coalesce(generate()), mimetype='text/plain', direct_passthrough=True)
+
+    def _stream_perplexity_or_openrouter(self, messages, cache_key=None):
         """Try streaming from Perplexity first; on failure, fall back to OpenRouter."""
+        if cache_key is None:
+            cache_key = ResponseCache.key_for_messages(messages)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            def replay():
+                yield cached.encode("utf-8")
+            return Response(replay(), mimetype='text/plain', direct_passthrough=True)
+
+        failed = {"flag": False}
+
         def generate():
             # 1) Try Perplexity
             if PERPLEXITY_API_KEY:
-                headers = {
-                    "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-                    "Content-Type": "application/json",
-                }
                 payload = {
                     "model": PRIMARY_CHAT_MODEL,
                     "messages": messages,
                     "stream": True,
                 }
                 try:
-                    with requests.post(PERPLEXITY_API_URL, headers=headers, json=payload, stream=True, timeout=60) as resp:
+                    with HTTP_CLIENT.stream("POST", PERPLEXITY_API_URL, headers=PERPLEXITY_HEADERS, content=json_dumps(payload)) as resp:
                         resp.raise_for_status()
-                        for line in resp.iter_lines():
-                            if not line:
-                                continue
-                            s = line.decode('utf-8', errors='ignore')
-                            if not s.startswith('data: '):
+                        for line in iter_sse_lines(resp):
+                            if not line.startswith(b'data: '):
                                 continue
+                            event = line[6:]
+                            if event == b'[DONE]':
+                                break
                             try:
-                                data = json.loads(s[6:])
+                                data = json_loads(event)
                                 delta = data.get('choices', [{}])[0].get('delta', {})
                                 content = delta.get('content', '')
                                 if content:
@@ -122,96 +240,139 @@ IMPORTANT: Do not include any links in your response. Provide text-only answers.
                             except Exception:
                                 continue
                         return
-                except Exception as e:
-                    print(f"Perplexity stream failed, falling back to OpenRouter: {e}")
+                except Exception:
+                    logger.warning("Perplexity stream failed, falling back to OpenRouter", exc_info=True)
+                    # Don't cache: the client may already have partial output.
+                    failed["flag"] = True
 
             # 2) Fallback to OpenRouter
             if not OPENROUTER_API_KEY:
+                failed["flag"] = True
                 yield "Sorry, no AI provider is configured."
                 return
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-            }
             payload = {
                 "model": OPENROUTER_FALLBACK_MODEL,
                 "messages": messages,
                 "stream": True,
             }
             try:
-                with requests.post(OPENROUTER_API_URL, headers=headers, json=payload, stream=True, timeout=60) as resp:
+                with HTTP_CLIENT.stream("POST", OPENROUTER_API_URL, headers=OPENROUTER_HEADERS, content=json_dumps(payload)) as resp:
                     resp.raise_for_status()
-                    for line in resp.iter_lines():
-                        if not line:
-                            continue
-                        s = line.decode('utf-8', errors='ignore')
-                        if not s.startswith('data: '):
+                    for line in iter_sse_lines(resp):
+                        if not line.startswith(b'data: '):
                             continue
+                        event = line[6:]
+                        if event == b'[DONE]':
+                            break
                         try:
-                            data = json.loads(s[6:])
+                            data = json_loads(event)
                             delta = data.get('choices', [{}])[0].get('delta', {})
                             content = delta.get('content', '')
                             if content:
                                 yield content
                         except Exception:
                             continue
-            except Exception as e:
-                print(f"OpenRouter stream failed: {e}")
+            except Exception:
+                logger.warning("OpenRouter stream failed", exc_info=True)
+                failed["flag"] = True
                 yield "Sorry, I encountered a connection error."
 
-        return Response(generate(), mimetype='text/plain')
+        def generate_and_cache():
+            parts = []
+            for chunk in generate():
+                parts.append(chunk)
+                yield chunk
+            if not failed["flag"]:
+                self.response_cache.put(cache_key, "".join(parts))
 
-    def _route_and_refine_query(self, query, chat_history_str):
-        system_prompt = """You are an expert query analysis agent...""" # Truncated for brevity
+        return Response(coalesce(generate_and_cache()), mimetype='text/plain', direct_passthrough=True)
+
+    def _route_and_refine_query(self, query, chat_history_str, emb_future=None):
+        # Cheap embedding 1-NN route first; one cached embedding call beats a
+        # full LLM generation for the clear-cut majority of turns. The future
+        # is handed through unresolved so regex-routed turns never wait on it.
+        intent = self.intent_classifier.classify(query, emb_future)
+        if intent is not None:
+            refined = refine_query(query, self._history_messages()) if intent == 'retrieval' else None
+            return {"intent": intent, "query": refined}
         user_prompt = f'Conversation History:\n{chat_history_str}\n\nUser Query: "{query}"\n\nYour JSON Output:'
-        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
         try:
-            payload = {"model": HELPER_MODEL, "messages": messages, "stream": False, "format": "json"}
-            response = requests.post(OLLAMA_CHAT_ENDPOINT, json=payload)
+            response = HTTP_CLIENT.post(OLLAMA_CHAT_ENDPOINT, content=_router_payload_bytes(user_prompt),
+                                        headers=JSON_HEADERS)
             response.raise_for_status()
-            response_data = response.json()
-            json_content = json.loads(response_data.get('message', {}).get('content', '{}'))
+            response_data = json_loads(response.content)
+            json_content = json_loads(response_data.get('message', {}).get('content', '{}'))
             return {"intent": json_content.get("intent", "conversation"), "query": json_content.get("query")}
-        except (requests.exceptions.RequestException, json.JSONDecodeError, KeyError) as e:
-            print(f"Error in routing/refining query: {e}")
+        except (httpx.HTTPError, ValueError, KeyError):
+            logger.warning("Error in routing/refining query", exc_info=True)
             return {"intent": "conversation", "query": query}
 
     def _get_news_guidance(self, query, user_profile):
         if not PERPLEXITY_API_KEY:
             return Response("The web search feature is not configured.", mimetype='text/plain')
-        headers = {"Authorization": f"Bearer {PERPLEXITY_API_KEY}", "Content-Type": "application/json"}
         system_prompt = "You are a helpful AI career and academic assistant. Format your response in Markdown, using headings and lists to make it easy to read. IMPORTANT: Do not include any links in your response. Provide text-only answers."
         user_context = f"- My Major: {user_profile.get('major', 'Not specified')}\n- My Ambition: {user_profile.get('ambition', 'Not specified')}\n\nMy Question: {query}"
         payload = {"model": GUIDANCE_SEARCH_MODEL, "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_context}], "stream": True}
+        cache_key = ResponseCache.semantic_key(system_prompt, user_context)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            def replay():
+                yield cached.encode("utf-8")
+            return Response(replay(), mimetype='text/plain', direct_passthrough=True)
         def generate():
+            parts = []
             try:
-                with requests.post(PERPLEXITY_API_URL, headers=headers, json=payload, stream=True) as response:
+                with HTTP_CLIENT.stream("POST", PERPLEXITY_API_URL, headers=PERPLEXITY_HEADERS, content=json_dumps(payload)) as response:
                     response.raise_for_status()
-                    for line in response.iter_lines():
-                        if line and line.decode('utf-8').startswith('data: '):
-                            try:
-                                json_data = json.loads(line.decode('utf-8')[6:])
-                                content = json_data['choices'][0]['delta'].get('content', '')
-                                if content:
-                                    yield content
-                            except (json.JSONDecodeError, KeyError):
-                                continue
-            except requests.exceptions.RequestException as e:
-                print(f"Error during web search: {e}")
+                    for line in iter_sse_lines(response):
+                        if not line.startswith(b'data: '):
+                            continue
+                        event = line[6:]
+                        if event == b'[DONE]':
+                            break
+                        try:
+                            json_data = json_loads(event)
+                            content = json_data['choices'][0]['delta'].get('content', '')
+                            if content:
+                                parts.append(content)
+                                yield content
+                        except (ValueError, KeyError):
+                            continue
+                self.response_cache.put(cache_key, "".join(parts))
+            except httpx.HTTPError:
+                logger.warning("Error during web search", exc_info=True)
                 yield "Sorry, I couldn't perform the web search."
-        return Response(generate(), mimetype='text/plain')
+        return Response(coalesce(generate()), mimetype='text/plain', direct_passthrough=True)
 
-    def _retrieve_context(self, query, collection):
+    def _retrieve_context(self, query, collection, query_embedding=None):
         if not query or not collection: return ""
-        query_embedding = self._get_ollama_embedding(query)
-        if not query_embedding: return ""
-        results = collection.query(query_embeddings=[query_embedding], n_results=5)
-        if not results or not results.get('documents'): return ""
-        return "\n\n---\n\n".join(results['documents'][0])
+        key = context_key(query)
+        cached = self._ctx_cache.get(key)
+        if cached is not None:
+            return cached
+        if query_embedding is None:
+            query_embedding = self._get_ollama_embedding(query)
+        if query_embedding is None: return ""
+        # Fuzzy hit: a near-identical recent query can donate its cached
+        # context, skipping the vector search for paraphrases.
+        alias = self.embedding_cache.similar_prompt(query_embedding, exclude=normalize_prompt(query))
+        if alias is not None:
+            cached = self._ctx_cache.get(context_key(alias))
+            if cached is not None:
+                self._ctx_cache[key] = cached
+                return cached
+        if self.vector_index.ready:
+            context = assemble_context(self.vector_index.search(query_embedding, n_results=5))
+        else:
+            results = collection.query(query_embeddings=[query_embedding], n_results=5)
+            if not results or not results.get('documents'): return ""
+            context = assemble_context(results['documents'][0])
+        self._ctx_cache[key] = context
+        return context
 
-    def _format_chat_history(self, history):
-        if not history: return "No previous conversation."
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+    def _format_chat_history(self):
+        if not self._roles: return "No previous conversation."
+        return "\n".join(f"{r}: {c}" for r, c in zip(self._roles, self._contents))
 
 chatbot = Chatbot()
 
@@ -219,23 +380,31 @@ chatbot = Chatbot()
 def index():
     return send_from_directory(app.static_folder, 'index.html')
 
+def _json_response(obj, status=200):
+    return app.response_class(json_dumps(obj), status=status, mimetype='application/json')
+
 @app.route('/chat', methods=['POST'])
 def chat():
-    data = request.json
-    user_message = data.get('message')
+    # Parse the body with orjson directly instead of Flask's json property,
+    # which keeps a second cached copy of the payload.
+    try:
+        data = json_loads(request.get_data(cache=False))
+    except ValueError:
+        return _json_response({'error': 'bad json'}, 400)
+    user_message = data.get('message') if isinstance(data, dict) else None
     if not user_message:
-        return jsonify({'error': 'No message provided'}), 400
-    
+        return _json_response({'error': 'No message provided'}, 400)
+
     # Here we get a generator/Response object
     response_stream = chatbot.process_query(user_message)
-    
+
     # We need to handle the streaming response properly
     return response_stream
 
 @app.route('/clear', methods=['POST'])
 def clear():
     chatbot.clear_session()
-    return jsonify({'status': 'cleared'})
+    return _json_response({'status': 'cleared'})
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
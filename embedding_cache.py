@@ -0,0 +1,131 @@
+import hashlib
+from collections import deque
+
+import numpy as np
+from cachetools import TTLCache
+
+from fastjson import json_dumps
+
+# --- Cache configuration ---
+EXACT_CACHE_SIZE = 512
+EXACT_CACHE_TTL = 600  # seconds
+FUZZY_CACHE_SIZE = 256
+SIMILARITY_THRESHOLD = 0.97
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 600  # seconds
+
+
+def normalize_prompt(prompt):
+    return prompt.strip().lower()
+
+
+def prompt_key(prompt):
+    """Returns the SHA-256 hex digest of the normalized prompt."""
+    return hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+
+
+def context_key(query):
+    """Key for cached retrieval contexts: blake2b of the normalized query.
+
+    blake2b is faster than SHA-256 in CPython and 16 bytes is plenty at
+    cache-sized cardinalities.
+    """
+    return hashlib.blake2b(normalize_prompt(query).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """Caches query embeddings so repeated turns skip the Ollama roundtrip.
+
+    Exact hits are keyed on the SHA-256 of the normalized prompt (LRU + TTL).
+    Vectors are L2-normalized once on insert, so every cosine similarity
+    downstream (fuzzy lookup, intent routing, FAISS inner product) is a pure
+    dot product with no per-query sqrt/div. A rolling contiguous matrix of
+    the unit vectors supports the fuzzy lookup: similar_prompt maps a fresh
+    embedding back to the normalized prompt of a semantically identical
+    earlier query, so callers can reuse whatever they computed for it
+    downstream (e.g. a cached retrieval context).
+    """
+
+    def __init__(self, maxsize=EXACT_CACHE_SIZE, ttl=EXACT_CACHE_TTL,
+                 fuzzy_size=FUZZY_CACHE_SIZE, threshold=SIMILARITY_THRESHOLD):
+        self._exact = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._keys = deque(maxlen=fuzzy_size)
+        self._matrix = None  # (N, d) unit vectors, rows parallel to _keys
+        self._threshold = threshold
+
+    def get(self, prompt):
+        """Returns the cached embedding for an exact (normalized) prompt hit."""
+        return self._exact.get(prompt_key(prompt))
+
+    def add(self, prompt, embedding):
+        """Caches the embedding as a unit vector and returns it."""
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        unit = vec / norm if norm else vec
+        self._exact[prompt_key(prompt)] = unit
+        if self._matrix is None:
+            self._matrix = unit[None, :]
+        else:
+            if len(self._keys) == self._keys.maxlen:
+                self._matrix = self._matrix[1:]
+            self._matrix = np.ascontiguousarray(np.vstack([self._matrix, unit]))
+        self._keys.append(normalize_prompt(prompt))
+        return unit
+
+    def similar_prompt(self, embedding, exclude=None):
+        """Returns the normalized prompt of the closest recent query, or None.
+
+        Rows are pre-normalized, so one BLAS matrix-vector product over the
+        rolling matrix yields the cosine scores directly; a hit means a
+        semantically identical query was seen recently. Pass the current
+        query's normalized prompt as ``exclude`` so a caller that already
+        inserted its own embedding doesn't just match itself.
+        """
+        if self._matrix is None or not self._keys:
+            return None
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if norm:
+            q = q / norm
+        sims = self._matrix @ q
+        if exclude is not None:
+            for i, stored in enumerate(self._keys):
+                if stored == exclude:
+                    sims[i] = -1.0
+        best = int(np.argmax(sims))
+        if sims[best] > self._threshold:
+            return self._keys[best]
+        return None
+
+
+class ResponseCache:
+    """TTL cache for fully-assembled LLM responses, keyed on a messages hash."""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def key_for_messages(messages):
+        payload = json_dumps(messages, sort_keys=True)
+        return hashlib.sha256(payload).hexdigest()
+
+    @staticmethod
+    def semantic_key(system_prompt, query, context=""):
+        """Key on what actually determines the answer.
+
+        Hashing the full message list misses every time a turn is appended
+        to history; hashing (system prompt, user question, retrieved
+        context) instead lets identical questions share a cached answer
+        across turns and sessions over the same corpus.
+        """
+        context_digest = hashlib.blake2b(context.encode("utf-8"), digest_size=16).digest()
+        return hashlib.blake2b(
+            b"\0".join([system_prompt.encode("utf-8"), query.encode("utf-8"), context_digest])
+        ).hexdigest()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def put(self, key, text):
+        if text:
+            self._cache[key] = text
@@ -0,0 +1,22 @@
+"""orjson-backed JSON helpers with a stdlib fallback.
+
+The streaming paths call loads once per streamed token, so a 2-5x faster
+parser is a direct tokens/sec win. json_dumps always returns UTF-8 bytes so
+callers can pass it straight to an HTTP client body.
+"""
+import json
+
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys).encode("utf-8")
@@ -0,0 +1,145 @@
+import re
+
+import numpy as np
+
+# Canonical utterances per intent. The classifier embeds these once (through
+# the caller's cached embedding function) and routes new queries by cosine
+# similarity, so most turns skip the LLM router entirely.
+ROUTER_EXAMPLES = {
+    "retrieval": [
+        "what are the prerequisites for CS101",
+        "details on CSE-412",
+        "how many credit hours is the machine learning course",
+        "who teaches the data structures course",
+        "what courses are offered in the computer science department",
+        "is there a lab component for the physics course",
+        "what is the syllabus for the AI course",
+        "am I eligible to take the advanced algorithms course",
+        "when is the database systems course offered",
+        "what electives can I take in my third semester",
+    ],
+    "guidance_search": [
+        "what career paths are open to me after this degree",
+        "which skills will be most in demand in the next five years",
+        "what is the job market like for data scientists",
+        "should I focus on AI or cybersecurity for my future",
+        "what industry trends should I know about",
+        "how do I prepare for a career in product management",
+        "what is best for me if I want to work abroad",
+        "which certifications would boost my employability",
+        "what are the latest developments in the tech industry",
+        "how competitive are graduate school admissions right now",
+    ],
+    "conversation": [
+        "hi",
+        "hello there",
+        "hey, how are you",
+        "thanks, that was helpful",
+        "good morning",
+        "who are you",
+        "what can you do",
+        "tell me a joke",
+        "okay sounds good",
+        "bye",
+    ],
+}
+
+# Minimum top-1 vs top-2 (different intent) similarity gap before trusting
+# the embedding route; anything closer falls back to the LLM router.
+CONFIDENCE_MARGIN = 0.05
+
+# Deterministic keyword fast-path, checked in order before any model call:
+# when a query plainly names one intent, routing costs a regex scan instead
+# of an embedding (or LLM) roundtrip.
+FAST_RULES = [
+    # Whole-message greetings only: "hi, what are the prereqs for CS101" is
+    # a catalog question, not small talk, so the rule must not fire on a
+    # greeting that merely prefixes a real query.
+    (re.compile(r"^(hi|hello|hey|thanks|thank you|bye|good (morning|afternoon|evening))[\s!,.]*$", re.I),
+     "conversation"),
+    (re.compile(r"\b(prereq\w*|credit hours?|instructors?|syllabus|course code|electives?|[a-z]{2,4}-?\d{3})\b", re.I),
+     "retrieval"),
+    (re.compile(r"\b(careers?|jobs?|industry|trends?|market|internships?|salar(y|ies))\b", re.I),
+     "guidance_search"),
+]
+
+
+def fast_intent(query):
+    """Returns the intent named by the first matching fast rule, or None."""
+    for pattern, intent in FAST_RULES:
+        if pattern.search(query):
+            return intent
+    return None
+
+_COREF_RE = re.compile(r"\b(it|its|that|this|those|these|they|them)\b", re.I)
+
+
+def refine_query(query, chat_history):
+    """Returns a retrieval query with cheap pronoun coreference resolution.
+
+    When the query leans on a pronoun and there is history, prepend the last
+    user turn so the vector search sees the referent; otherwise the raw user
+    text is already the best search string.
+    """
+    if chat_history and _COREF_RE.search(query):
+        last_user = next((m["content"] for m in reversed(chat_history) if m["role"] == "user"), "")
+        if last_user and last_user != query:
+            return f"{last_user} {query}"
+    return query
+
+
+class IntentClassifier:
+    """1-NN intent classification over embedded canonical examples.
+
+    classify() returns one of the ROUTER_EXAMPLES intents, or None when the
+    similarity margin between the two closest intents is too small to trust
+    (the caller should then fall back to its LLM router). Example embeddings
+    are fetched lazily on first use so a cold Ollama at startup only costs a
+    fallback, not a crash.
+    """
+
+    def __init__(self, embed_fn):
+        self._embed = embed_fn
+        self._matrix = None
+        self._labels = []
+
+    def _ensure_examples(self):
+        if self._matrix is not None:
+            return True
+        vectors, labels = [], []
+        for intent, examples in ROUTER_EXAMPLES.items():
+            for text in examples:
+                embedding = self._embed(text)
+                if embedding is None:
+                    return False
+                vectors.append(np.asarray(embedding, dtype=np.float32))
+                labels.append(intent)
+        matrix = np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._matrix = matrix
+        self._labels = labels
+        return True
+
+    def classify(self, query, embedding_future=None):
+        intent = fast_intent(query)
+        if intent is not None:
+            return intent
+        if not self._ensure_examples():
+            return None
+        # Resolve the speculative embedding only now that the 1-NN stage
+        # actually needs the vector; fast-path turns above never block on
+        # the Ollama roundtrip.
+        embedding = embedding_future.result() if embedding_future is not None else self._embed(query)
+        if embedding is None:
+            return None
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if not norm:
+            return None
+        sims = self._matrix @ (q / norm)
+        best = int(np.argmax(sims))
+        best_label = self._labels[best]
+        others = [s for s, label in zip(sims, self._labels) if label != best_label]
+        if others and float(sims[best]) - max(others) < CONFIDENCE_MARGIN:
+            return None
+        return best_label
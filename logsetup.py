@@ -0,0 +1,27 @@
+"""Non-blocking logging for the request hot path.
+
+print() takes the interpreter-wide stdout lock on every message, which can
+serialize workers during error-heavy streaming fallbacks. Loggers from here
+push records onto an in-process queue; a single background listener writes
+them to stderr, so the request thread never blocks on I/O.
+"""
+import logging
+import logging.handlers
+import queue
+
+_queue = queue.Queue(-1)
+_listener = None
+
+
+def get_logger(name):
+    global _listener
+    if _listener is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s"))
+        _listener = logging.handlers.QueueListener(_queue, handler)
+        _listener.start()
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.handlers.QueueHandler(_queue))
+        logger.setLevel(logging.INFO)
+    return logger
@@ -1,10 +1,22 @@
+import atexit
 import os
-import json
-import requests
+import time
+import httpx
 import chromadb
-from flask import Flask, request, jsonify, Response
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response
 from dotenv import load_dotenv
 
+from cachetools import TTLCache
+
+from embedding_cache import EmbeddingCache, ResponseCache, context_key, normalize_prompt
+from fastjson import json_dumps, json_loads
+from intent_router import IntentClassifier, refine_query
+from logsetup import get_logger
+from sse import coalesce, iter_sse_lines
+from vector_index import VectorIndex, assemble_context
+
 """
 New RAG Backend (derived from newragsearch.py)
 
@@ -28,6 +40,8 @@ Set environment variables:
 
 load_dotenv()
 
+logger = get_logger('nexus.newrag')
+
 app = Flask(__name__)
 
 # Allow simple CORS for local development (frontend served from a different port)
@@ -51,6 +65,28 @@ PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+# Headers are constant per provider; build them once.
+JSON_HEADERS = {"Content-Type": "application/json"}
+PERPLEXITY_HEADERS = (
+    {"Authorization": f"Bearer {PERPLEXITY_API_KEY}", "Content-Type": "application/json"}
+    if PERPLEXITY_API_KEY else None
+)
+OPENROUTER_HEADERS = (
+    {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
+    if OPENROUTER_API_KEY else None
+)
+
+# Shared HTTP client: HTTP/2 multiplexing plus connection reuse across all
+# upstream calls (one TLS handshake per host instead of one per request).
+HTTP_CLIENT = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(120.0, connect=10.0),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+# Worker pool for overlapping independent upstream calls within one turn.
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
 # Models
 GENERATION_MODEL = "mistral:latest"
 EMBEDDING_MODEL = "nomic-embed-text:latest"
@@ -62,6 +98,50 @@ OPENROUTER_FALLBACK_MODEL = "openai/gpt-oss-20b:free"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMA_DB_PATH = os.path.join(SCRIPT_DIR, "chroma_db")
 COLLECTION_NAME = "pdf_embeddings"
+FAISS_INDEX_PATH = os.path.join(SCRIPT_DIR, "faiss_index.bin")
+
+# Hard cap on retained history messages; bounds both memory and the token
+# cost of every upstream prompt that embeds the conversation.
+MAX_HISTORY_MESSAGES = 20
+
+# --- Static prompts (serialized/built once) ---
+ROUTER_SYSTEM_PROMPT = (
+    "You are an expert query analysis agent. Your task is to analyze a user's query and conversation history, "
+    "then output a JSON object with two fields: 'intent' and 'query'.\n\n"
+    "1. 'intent': retrieval | guidance_search | conversation\n"
+    "2. 'query': If 'retrieval', rewrite the query for vector search; otherwise null.\n\n"
+    "IMPORTANT: Output must be a single valid JSON object."
+)
+
+GUIDANCE_SYSTEM_PROMPT = (
+    "You are a helpful AI career and academic assistant. Provide a concise, web-informed summary. "
+    "Format with simple Markdown (headings, lists). Do not include links."
+)
+
+RETRIEVAL_SYSTEM_PROMPT = (
+    "You are 'Nexus,' the AI Academic Counsellor for Sai University. Use ONLY the provided context. "
+    "Format in clear Markdown with headings and bullet points. Do not include links."
+)
+
+CONVERSATION_PERSONA = {
+    "role": "system",
+    "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University. Do not include links.",
+}
+
+# The router payload never changes apart from the user message, so serialize
+# the scaffolding once and splice in only the user-message bytes per call
+# (the [:-2] strips the closing b']}' of the messages list, re-added below).
+_ROUTER_PAYLOAD_PREFIX = json_dumps({
+    "model": HELPER_MODEL,
+    "stream": False,
+    "format": "json",
+    "messages": [{"role": "system", "content": ROUTER_SYSTEM_PROMPT}],
+})[:-2]
+
+
+def _router_payload_bytes(user_prompt):
+    return b"".join([_ROUTER_PAYLOAD_PREFIX, b",",
+                     json_dumps({"role": "user", "content": user_prompt}), b"]}"])
 
 
 class NewRAGService:
@@ -70,65 +150,147 @@ class NewRAGService:
         try:
             self.client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
             self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME)
-            print("[NewRAG] Connected to ChromaDB collection.")
-        except Exception as e:
-            print(f"[NewRAG] Error connecting to ChromaDB: {e}")
+            logger.info("Connected to ChromaDB collection.")
+        except Exception:
+            logger.warning("Error connecting to ChromaDB", exc_info=True)
             self.collection = None
-        # Simple in-memory session
-        self.chat_history = []
+        self.vector_index = VectorIndex(self.collection, FAISS_INDEX_PATH)
+        # Simple in-memory session; history as parallel ring buffers for
+        # O(1) truncation and fewer per-turn allocations.
+        self._roles = deque(maxlen=MAX_HISTORY_MESSAGES)
+        self._contents = deque(maxlen=MAX_HISTORY_MESSAGES)
         self.user_profile = {"major": None, "ambition": None}
         self.awaiting_ambition = False
+        self.embedding_cache = EmbeddingCache()
+        self.response_cache = ResponseCache()
+        self.intent_classifier = IntentClassifier(self._get_ollama_embedding)
+        self._ctx_cache = TTLCache(maxsize=256, ttl=300)
+        # Buffered writes (see add_documents); flush on interpreter exit so
+        # a final sub-batch is never stranded in the buffer.
+        self._pending = []
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)
+
+    # -------- Batched writes --------
+    # The running service is read-mostly; when documents are added through it,
+    # buffer them so Chroma sees a few large adds instead of many small ones
+    # (per-call pickling makes tiny adds disproportionately expensive).
+    WRITE_BATCH_SIZE = 250
+    WRITE_FLUSH_INTERVAL = 1.0  # seconds
+
+    def add_documents(self, ids, embeddings, documents):
+        if not self.collection:
+            # Nothing to write into; don't hoard rows that can never flush.
+            return
+        self._pending.extend(zip(ids, embeddings, documents))
+        if (len(self._pending) >= self.WRITE_BATCH_SIZE
+                or time.monotonic() - self._last_flush >= self.WRITE_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """Writes any buffered rows immediately.
+
+        The FAISS index and context cache are updated in step, so rows
+        written at runtime are searchable instead of silently shadowed by
+        the startup snapshot.
+        """
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        if not self.collection:
+            return
+        ids, embeddings, documents = map(list, zip(*pending))
+        self.collection.add(ids=ids, embeddings=embeddings, documents=documents)
+        if not self.vector_index.extend(embeddings, documents):
+            # No live index to extend (e.g. the collection was empty at
+            # startup); rebuild from the now-populated collection.
+            self.vector_index = VectorIndex(self.collection, FAISS_INDEX_PATH)
+        self._ctx_cache.clear()
 
     # -------- Embeddings / Retrieval --------
     def _get_ollama_embedding(self, prompt: str):
+        cached = self.embedding_cache.get(prompt)
+        if cached is not None:
+            return cached
         try:
             payload = {"model": EMBEDDING_MODEL, "prompt": prompt}
-            resp = requests.post(OLLAMA_EMBED_ENDPOINT, json=payload, timeout=60)
+            resp = HTTP_CLIENT.post(OLLAMA_EMBED_ENDPOINT, content=json_dumps(payload),
+                                    headers=JSON_HEADERS, timeout=60)
             resp.raise_for_status()
-            return resp.json().get("embedding")
-        except requests.exceptions.RequestException as e:
-            print(f"[NewRAG] Embedding error: {e}")
+            embedding = json_loads(resp.content).get("embedding")
+            if embedding is None:
+                return None
+            return self.embedding_cache.add(prompt, embedding)
+        except httpx.HTTPError:
+            logger.warning("Embedding error", exc_info=True)
             return None
 
-    def _retrieve_context(self, query: str):
+    def _retrieve_context(self, query: str, query_embedding=None):
         if not query or not self.collection:
             return ""
-        embedding = self._get_ollama_embedding(query)
-        if not embedding:
-            return ""
-        results = self.collection.query(query_embeddings=[embedding], n_results=5)
-        if not results or not results.get("documents"):
+        key = context_key(query)
+        cached = self._ctx_cache.get(key)
+        if cached is not None:
+            return cached
+        embedding = query_embedding
+        if embedding is None:
+            embedding = self._get_ollama_embedding(query)
+        if embedding is None:
             return ""
-        return "\n\n---\n\n".join(results["documents"][0])
+        # Fuzzy hit: a near-identical recent query can donate its cached
+        # context, skipping the vector search for paraphrases.
+        alias = self.embedding_cache.similar_prompt(embedding, exclude=normalize_prompt(query))
+        if alias is not None:
+            cached = self._ctx_cache.get(context_key(alias))
+            if cached is not None:
+                self._ctx_cache[key] = cached
+                return cached
+        if self.vector_index.ready:
+            context = assemble_context(self.vector_index.search(embedding, n_results=5))
+        else:
+            results = self.collection.query(query_embeddings=[embedding], n_results=5)
+            if not results or not results.get("documents"):
+                return ""
+            context = assemble_context(results["documents"][0])
+        self._ctx_cache[key] = context
+        return context
 
     # -------- LLM Streaming --------
     def _stream_ollama(self, messages):
         def generate():
             try:
                 payload = {"model": GENERATION_MODEL, "messages": messages, "stream": True}
-                with requests.post(OLLAMA_CHAT_ENDPOINT, json=payload, stream=True, timeout=120) as r:
+                with HTTP_CLIENT.stream("POST", OLLAMA_CHAT_ENDPOINT, content=json_dumps(payload), headers=JSON_HEADERS) as r:
                     r.raise_for_status()
-                    for line in r.iter_lines():
-                        if not line:
-                            continue
+                    for line in iter_sse_lines(r):
                         try:
-                            data = json.loads(line)
+                            data = json_loads(line)
                             content = data.get("message", {}).get("content", "")
                             if content:
                                 yield content
-                        except json.JSONDecodeError:
+                        except ValueError:
                             continue
-            except requests.exceptions.RequestException as e:
-                print(f"[NewRAG] Ollama stream error: {e}")
+            except httpx.HTTPError:
+                logger.warning("Ollama stream error", exc_info=True)
                 yield "Sorry, I encountered a connection error."
-        return Response(generate(), mimetype="text/plain")
+        return Response(coalesce(generate()), mimetype="text/plain", direct_passthrough=True)
 
     def _stream_perplexity_or_openrouter(self, system_prompt: str, user_content: str):
         """Try Perplexity first; if it fails or not configured, fall back to OpenRouter."""
+        cache_key = ResponseCache.semantic_key(system_prompt, user_content)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            def replay():
+                yield cached.encode("utf-8")
+            return Response(replay(), mimetype="text/plain", direct_passthrough=True)
+
+        failed = {"flag": False}
+
         def generate():
             # 1) Perplexity attempt
             if PERPLEXITY_API_KEY:
-                headers = {"Authorization": f"Bearer {PERPLEXITY_API_KEY}", "Content-Type": "application/json"}
                 payload = {
                     "model": GUIDANCE_SEARCH_MODEL,
                     "messages": [
@@ -138,30 +300,32 @@ class NewRAGService:
                     "stream": True,
                 }
                 try:
-                    with requests.post(PERPLEXITY_API_URL, headers=headers, json=payload, stream=True, timeout=120) as r:
+                    with HTTP_CLIENT.stream("POST", PERPLEXITY_API_URL, headers=PERPLEXITY_HEADERS, content=json_dumps(payload)) as r:
                         r.raise_for_status()
-                        for line in r.iter_lines():
-                            if not line:
-                                continue
-                            s = line.decode("utf-8", errors="ignore")
-                            if not s.startswith("data: "):
+                        for line in iter_sse_lines(r):
+                            if not line.startswith(b"data: "):
                                 continue
+                            event = line[6:]
+                            if event == b"[DONE]":
+                                break
                             try:
-                                data = json.loads(s[6:])
+                                data = json_loads(event)
                                 content = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
                                 if content:
                                     yield content
                             except Exception:
                                 continue
                         return
-                except Exception as e:
-                    print(f"[NewRAG] Perplexity stream error, falling back to OpenRouter: {e}")
+                except Exception:
+                    logger.warning("Perplexity stream error, falling back to OpenRouter", exc_info=True)
+                    # Don't cache: the client may already have partial output.
+                    failed["flag"] = True
 
             # 2) OpenRouter fallback
             if not OPENROUTER_API_KEY:
+                failed["flag"] = True
                 yield "The web search feature is not configured."
                 return
-            headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
             payload = {
                 "model": OPENROUTER_FALLBACK_MODEL,
                 "messages": [
@@ -171,56 +335,65 @@ class NewRAGService:
                 "stream": True,
             }
             try:
-                with requests.post(OPENROUTER_API_URL, headers=headers, json=payload, stream=True, timeout=120) as r:
+                with HTTP_CLIENT.stream("POST", OPENROUTER_API_URL, headers=OPENROUTER_HEADERS, content=json_dumps(payload)) as r:
                     r.raise_for_status()
-                    for line in r.iter_lines():
-                        if not line:
-                            continue
-                        s = line.decode("utf-8", errors="ignore")
-                        if not s.startswith("data: "):
+                    for line in iter_sse_lines(r):
+                        if not line.startswith(b"data: "):
                             continue
+                        event = line[6:]
+                        if event == b"[DONE]":
+                            break
                         try:
-                            data = json.loads(s[6:])
+                            data = json_loads(event)
                             content = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
                             if content:
                                 yield content
                         except Exception:
                             continue
-            except Exception as e:
-                print(f"[NewRAG] OpenRouter stream error: {e}")
+            except Exception:
+                logger.warning("OpenRouter stream error", exc_info=True)
+                failed["flag"] = True
                 yield "Sorry, I couldn't perform the web search."
-        return Response(generate(), mimetype="text/plain")
+
+        def generate_and_cache():
+            parts = []
+            for chunk in generate():
+                parts.append(chunk)
+                yield chunk
+            if not failed["flag"]:
+                self.response_cache.put(cache_key, "".join(parts))
+
+        return Response(coalesce(generate_and_cache()), mimetype="text/plain", direct_passthrough=True)
 
     # -------- Router --------
     def _format_history(self):
-        if not self.chat_history:
+        if not self._roles:
             return "No previous conversation."
-        return "\n".join([f"{m['role']}: {m['content']}" for m in self.chat_history])
-
-    def _route_and_refine(self, query: str):
-        system_prompt = (
-            "You are an expert query analysis agent. Your task is to analyze a user's query and conversation history, "
-            "then output a JSON object with two fields: 'intent' and 'query'.\n\n"
-            "1. 'intent': retrieval | guidance_search | conversation\n"
-            "2. 'query': If 'retrieval', rewrite the query for vector search; otherwise null.\n\n"
-            "IMPORTANT: Output must be a single valid JSON object."
-        )
+        return "\n".join(f"{r}: {c}" for r, c in zip(self._roles, self._contents))
+
+    def _history_messages(self):
+        return [{"role": r, "content": c} for r, c in zip(self._roles, self._contents)]
+
+    def _route_and_refine(self, query: str, emb_future=None):
+        # Cheap embedding 1-NN route first; one cached embedding call beats a
+        # full LLM generation for the clear-cut majority of turns. The future
+        # is handed through unresolved so regex-routed turns never wait on it.
+        intent = self.intent_classifier.classify(query, emb_future)
+        if intent is not None:
+            refined = refine_query(query, self._history_messages()) if intent == "retrieval" else None
+            return {"intent": intent, "query": refined}
         user_prompt = f"Conversation History:\n{self._format_history()}\n\nUser Query: \"{query}\"\n\nYour JSON Output:"
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
         try:
-            payload = {"model": HELPER_MODEL, "messages": messages, "stream": False, "format": "json"}
-            resp = requests.post(OLLAMA_CHAT_ENDPOINT, json=payload, timeout=120)
+            resp = HTTP_CLIENT.post(OLLAMA_CHAT_ENDPOINT, content=_router_payload_bytes(user_prompt),
+                                    headers=JSON_HEADERS, timeout=120)
             resp.raise_for_status()
-            data = resp.json()
-            json_content = json.loads(data.get("message", {}).get("content", "{}"))
+            data = json_loads(resp.content)
+            json_content = json_loads(data.get("message", {}).get("content", "{}"))
             intent = json_content.get("intent", "conversation")
             refined = json_content.get("query")
             return {"intent": intent, "query": refined}
-        except Exception as e:
-            print(f"[NewRAG] Router error: {e}")
+        except Exception:
+            logger.warning("Router error", exc_info=True)
             return {"intent": "conversation", "query": query}
 
     # -------- Public handlers --------
@@ -237,8 +410,10 @@ class NewRAGService:
                 yield reply
             return Response(gen_once(), mimetype="text/plain")
 
-        # Route
-        routing = self._route_and_refine(user_text)
+        # Route, embedding the raw query speculatively in parallel; retrieval
+        # turns reuse the future instead of a serial Ollama roundtrip.
+        fut_emb = EXECUTOR.submit(self._get_ollama_embedding, user_text)
+        routing = self._route_and_refine(user_text, fut_emb)
         intent = routing["intent"]
 
         if intent == "guidance_search":
@@ -252,45 +427,38 @@ class NewRAGService:
                     yield reply
                 return Response(gen_once(), mimetype="text/plain")
             # Use Perplexity
-            system_prompt = (
-                "You are a helpful AI career and academic assistant. Provide a concise, web-informed summary. "
-                "Format with simple Markdown (headings, lists). Do not include links."
-            )
             user_ctx = (
                 f"- My Major: {self.user_profile.get('major', 'Not specified')}\n"
                 f"- My Ambition: {self.user_profile.get('ambition', 'Not specified')}\n\n"
                 f"My Question: {user_text}"
             )
             # Note: history is not embedded into Perplexity call beyond this for simplicity
-            return self._stream_perplexity_or_openrouter(system_prompt, user_ctx)
+            return self._stream_perplexity_or_openrouter(GUIDANCE_SYSTEM_PROMPT, user_ctx)
 
         if intent == "retrieval":
-            context = self._retrieve_context(routing.get("query"))
-            system_prompt = (
-                "You are 'Nexus,' the AI Academic Counsellor for Sai University. Use ONLY the provided context. "
-                "Format in clear Markdown with headings and bullet points. Do not include links."
-            )
+            target = routing.get("query")
+            precomputed = fut_emb.result() if target == user_text else None
+            context = self._retrieve_context(target, precomputed)
             user_with_ctx = (
                 f"Context from university documents:\n---\n{context or 'No context was found for this query.'}\n---\n"
                 f"Based on the context above and our prior conversation, please answer my last question: \"{user_text}\" "
             )
-            messages = [{"role": "system", "content": system_prompt}] + self.chat_history + [{"role": "user", "content": user_with_ctx}]
+            messages = [{"role": "system", "content": RETRIEVAL_SYSTEM_PROMPT}] + self._history_messages() + [{"role": "user", "content": user_with_ctx}]
             return self._stream_ollama(messages)
 
         # conversation
-        persona = {
-            "role": "system",
-            "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University. Do not include links.",
-        }
-        messages = [persona] + self.chat_history + [{"role": "user", "content": user_text}]
+        messages = [CONVERSATION_PERSONA] + self._history_messages() + [{"role": "user", "content": user_text}]
         return self._stream_ollama(messages)
 
     def _append_history(self, user_text: str, assistant_text: str):
-        self.chat_history.append({"role": "user", "content": user_text})
-        self.chat_history.append({"role": "assistant", "content": assistant_text})
+        self._roles.append("user")
+        self._contents.append(user_text)
+        self._roles.append("assistant")
+        self._contents.append(assistant_text)
 
     def clear(self):
-        self.chat_history = []
+        self._roles.clear()
+        self._contents.clear()
         self.user_profile = {"major": None, "ambition": None}
         self.awaiting_ambition = False
 
@@ -307,32 +475,43 @@ def index():
         {"Content-Type": "text/plain"},
     )
 
+def _json_response(obj, status=200):
+    return app.response_class(json_dumps(obj), status=status, mimetype="application/json")
+
+
 @app.route("/api/newrag/health", methods=["GET"])
 def health():
     status = {
         "chroma_connected": bool(service.collection),
         "perplexity_configured": bool(PERPLEXITY_API_KEY),
     }
-    return jsonify(status)
+    return _json_response(status)
 
 
 @app.route("/api/newrag/chat", methods=["POST"])
 def chat():
-    data = request.get_json(silent=True) or {}
+    # Parse the body with orjson directly instead of Flask's json property,
+    # which keeps a second cached copy of the payload.
+    try:
+        data = json_loads(request.get_data(cache=False))
+    except ValueError:
+        return _json_response({"error": "bad json"}, 400)
+    if not isinstance(data, dict):
+        data = {}
     msg = data.get("message", "").strip()
     # Optional: update profile if provided
     profile = data.get("profile")
     if isinstance(profile, dict):
         service.user_profile.update({k: v for k, v in profile.items() if k in ("major", "ambition")})
     if not msg:
-        return jsonify({"error": "No message provided"}), 400
+        return _json_response({"error": "No message provided"}, 400)
     return service.handle_message(msg)
 
 
 @app.route("/api/newrag/clear", methods=["POST"])
 def clear():
     service.clear()
-    return jsonify({"status": "cleared"})
+    return _json_response({"status": "cleared"})
 
 
 if __name__ == "__main__":
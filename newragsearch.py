@@ -1,7 +1,26 @@
 import chromadb
-import requests
-import json
+import functools
+from collections import deque
+import httpx
 import os
+import pickle
+import re
+import time
+
+import numpy as np
+
+from fastjson import json_loads
+from sse import iter_sse_lines
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
 
 # --- Configuration ---
 # Ollama API endpoints
@@ -25,40 +44,211 @@ CHROMA_DB_PATH = "./chroma_db"
 COLLECTION_NAME = "pdf_embeddings"
 
 
+# Shared HTTP client: HTTP/2 multiplexing lets the router call, streaming
+# generation and concurrent embedding requests share one connection.
+CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+    timeout=httpx.Timeout(300.0, connect=10.0),
+)
+
+
+# Semantic response cache: (unit embedding, response) pairs persisted between
+# sessions. A new query whose embedding is close enough to a cached one gets
+# the stored answer without retrieval or generation. Entries are namespaced
+# by embedding model and expire after a day so answers can't go stale.
+SEMANTIC_CACHE_PATH = "./query_cache.pkl"
+SEMANTIC_CACHE_TTL = 24 * 3600  # seconds
+SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+
+
+if njit is not None:
+    # JIT-compiled scorer for the hot cosine loops (semantic cache lookup and
+    # MMR relevance); cache=True keeps the compile cost to the first run ever.
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cosine_scores(q, matrix):
+        rows = matrix.shape[0]
+        out = np.empty(rows, dtype=np.float32)
+        for i in prange(rows):
+            acc = np.float32(0.0)
+            for j in range(matrix.shape[1]):
+                acc += q[j] * matrix[i, j]
+            out[i] = acc
+        return out
+else:
+    def _cosine_scores(q, matrix):
+        return matrix @ q
+
+
+def _load_semantic_cache():
+    try:
+        with open(SEMANTIC_CACHE_PATH, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("model") == EMBEDDING_MODEL:
+            return cache
+    except (OSError, pickle.PickleError, EOFError):
+        pass
+    return {"model": EMBEDDING_MODEL, "entries": []}
+
+
+_semantic_cache = _load_semantic_cache()
+
+# FAISS exact inner-product index over the cache entries (rows parallel to
+# the entries list), so lookups stay sub-millisecond as the cache grows.
+# Rebuilt from the pickled vectors whenever entries are added or expire -
+# cheap at cache cardinalities, and it avoids keeping a second on-disk copy
+# of the vectors in sync.
+_semantic_index = None
+
+
+def _rebuild_semantic_index():
+    global _semantic_index
+    entries = _semantic_cache["entries"]
+    if faiss is None or not entries:
+        _semantic_index = None
+        return
+    matrix = np.ascontiguousarray(np.stack([e[0] for e in entries]), dtype=np.float32)
+    index = faiss.IndexFlatIP(matrix.shape[1])
+    index.add(matrix)
+    _semantic_index = index
+
+
+def _save_semantic_cache():
+    try:
+        with open(SEMANTIC_CACHE_PATH, "wb") as f:
+            pickle.dump(_semantic_cache, f)
+    except OSError as e:
+        print(f"\n[Could not persist semantic cache: {e}]")
+
+
+def semantic_cache_lookup(embedding):
+    """Returns a cached response for a semantically identical query, or None."""
+    if embedding is None:
+        return None
+    now = time.time()
+    entries = [e for e in _semantic_cache["entries"] if now - e[2] < SEMANTIC_CACHE_TTL]
+    pruned = len(entries) != len(_semantic_cache["entries"])
+    _semantic_cache["entries"] = entries
+    if not entries:
+        return None
+    q = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(q)
+    if not norm:
+        return None
+    q = q / norm
+    if faiss is not None:
+        if pruned or _semantic_index is None or _semantic_index.ntotal != len(entries):
+            _rebuild_semantic_index()
+        scores, ids = _semantic_index.search(np.ascontiguousarray(q[None, :]), 1)
+        if scores[0, 0] > SEMANTIC_SIMILARITY_THRESHOLD:
+            return entries[int(ids[0, 0])][1]
+        return None
+    matrix = np.ascontiguousarray(np.stack([e[0] for e in entries]), dtype=np.float32)
+    sims = _cosine_scores(q, matrix)
+    best = int(np.argmax(sims))
+    if sims[best] > SEMANTIC_SIMILARITY_THRESHOLD:
+        return entries[best][1]
+    return None
+
+
+def semantic_cache_store(embedding, response):
+    if embedding is None or not response:
+        return
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    if not norm:
+        return
+    unit = vec / norm
+    _semantic_cache["entries"].append((unit, response, time.time()))
+    if faiss is not None and _semantic_index is not None and _semantic_index.d == unit.shape[0]:
+        _semantic_index.add(np.ascontiguousarray(unit[None, :]))
+    _save_semantic_cache()
+
+
+@functools.lru_cache(maxsize=512)
+def _fetch_embedding(prompt):
+    payload = {"model": EMBEDDING_MODEL, "prompt": prompt}
+    response = CLIENT.post(OLLAMA_EMBED_ENDPOINT, json=payload)
+    response.raise_for_status()
+    embedding = response.json().get("embedding")
+    if embedding is None:
+        raise ValueError("no embedding in Ollama response")
+    return tuple(embedding)
+
+
 def get_ollama_embedding(prompt):
-    """Gets an embedding from Ollama."""
+    """Gets an embedding from Ollama, memoized on the exact prompt string.
+
+    Failures raise inside the memoized helper, so they are never cached.
+    """
     try:
-        payload = {"model": EMBEDDING_MODEL, "prompt": prompt}
-        response = requests.post(OLLAMA_EMBED_ENDPOINT, json=payload)
-        response.raise_for_status()
-        return response.json().get("embedding")
-    except requests.exceptions.RequestException as e:
+        return list(_fetch_embedding(prompt))
+    except (httpx.HTTPError, ValueError) as e:
         print(f"\nError getting embedding from Ollama: {e}")
         return None
 
+# Matches the content field inside a raw streaming frame; most of each
+# frame is {"done":false,...} boilerplate around a short token, so pulling
+# the field out with a byte regex skips building a dict per token.
+_CONTENT_RE = re.compile(rb'"content":"((?:[^"\\]|\\.)*)"')
+
+
 def stream_ollama_chat_response(model, messages):
     """Streams a chat response from Ollama, yielding content chunks."""
     try:
         payload = {"model": model, "messages": messages, "stream": True}
-        with requests.post(OLLAMA_CHAT_ENDPOINT, json=payload, stream=True) as response:
+        with CLIENT.stream("POST", OLLAMA_CHAT_ENDPOINT, json=payload) as response:
             response.raise_for_status()
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line)
-                        content = chunk.get('message', {}).get('content', '')
-                        if content:
-                            yield content
-                    except json.JSONDecodeError:
-                        continue
-    except requests.exceptions.RequestException as e:
+            for line in iter_sse_lines(response):
+                # Fast path: escape-free content decodes straight from the
+                # matched bytes. Frames with escapes, or without a content
+                # match (e.g. the terminal done:true frame), take the full
+                # orjson parse.
+                match = _CONTENT_RE.search(line)
+                if match is not None and b'\\' not in match.group(1):
+                    content = match.group(1)
+                    if content:
+                        yield content.decode('utf-8')
+                    continue
+                try:
+                    chunk = json_loads(line)
+                    content = chunk.get('message', {}).get('content', '')
+                    if content:
+                        yield content
+                except ValueError:
+                    continue
+    except httpx.HTTPError as e:
         print(f"\nError streaming from Ollama API: {e}")
         yield "Sorry, I encountered a connection error."
 
+# Router decisions are a pure function of (query, recent history) with low
+# output entropy, so repeated phrasings can skip the LLM round-trip.
+ROUTE_CACHE_SIZE = 256
+_route_cache = {}
+
+# Obvious greetings never need the router at all. The whole message must be
+# the greeting (plus optional punctuation) - 'hi, what about CSE-412' is a
+# real question and has to reach the router.
+_GREETING_RE = re.compile(r"^(hi|hello|hey|thanks|thank you|bye)[\s!,.]*$", re.I)
+
+
 def route_and_refine_query(query, chat_history_str):
     """
     Analyzes the user's query and decides the best course of action.
     """
+    if _GREETING_RE.match(query.strip()):
+        print("  [Router decision: conversation (greeting fast-path)]")
+        return {"intent": "conversation", "query": None}
+
+    # Key on the normalized query plus the last two formatted history lines;
+    # earlier history rarely changes the routing decision.
+    recent = "\n".join(chat_history_str.splitlines()[-2:])
+    cache_key = (query.strip().lower(), hash(recent))
+    cached = _route_cache.get(cache_key)
+    if cached is not None:
+        print(f"  [Router decision: {cached['intent']} (cached)]")
+        return cached
+
     system_prompt = """You are an expert query analysis agent. Your task is to analyze a user's query and conversation history, then output a JSON object with two fields: "intent" and "query".
 
 1.  *"intent"*: Classify the user's primary goal into one of three categories:
@@ -83,11 +273,13 @@ Your JSON Output:"""
     
     try:
         payload = {"model": HELPER_MODEL, "messages": messages, "stream": False, "format": "json"}
-        response = requests.post(OLLAMA_CHAT_ENDPOINT, json=payload)
+        response = CLIENT.post(OLLAMA_CHAT_ENDPOINT, json=payload)
         response.raise_for_status()
         
-        response_data = response.json()
-        json_content = json.loads(response_data.get('message', {}).get('content', '{}'))
+        # Parse the Ollama envelope once from raw bytes with orjson; the
+        # format=json content field is itself JSON and gets the same parser.
+        response_data = json_loads(response.content)
+        json_content = json_loads(response_data.get('message', {}).get('content', '{}'))
         
         intent = json_content.get("intent", "conversation")
         refined_query = json_content.get("query")
@@ -96,9 +288,13 @@ Your JSON Output:"""
         if intent == "retrieval":
              print(f"  [Refined Query for Search: '{refined_query}']")
 
-        return {"intent": intent, "query": refined_query}
+        result = {"intent": intent, "query": refined_query}
+        if len(_route_cache) >= ROUTE_CACHE_SIZE:
+            _route_cache.pop(next(iter(_route_cache)))
+        _route_cache[cache_key] = result
+        return result
         
-    except (requests.exceptions.RequestException, json.JSONDecodeError, KeyError) as e:
+    except (httpx.HTTPError, ValueError, KeyError) as e:
         print(f"\nError in routing/refining query: {e}")
         return {"intent": "conversation", "query": query}
 
@@ -132,43 +328,113 @@ def get_news_guidance(query: str, user_profile: dict) -> str:
     }
     
     try:
-        with requests.post(PERPLEXITY_API_URL, headers=headers, json=payload, stream=True) as response:
+        with CLIENT.stream("POST", PERPLEXITY_API_URL, headers=headers, json=payload) as response:
             response.raise_for_status()
-            for line in response.iter_lines():
-                if line:
-                    line_str = line.decode('utf-8')
-                    if line_str.startswith('data: '):
-                        try:
-                            json_data = json.loads(line_str[6:])
-                            content = json_data['choices'][0]['delta'].get('content', '')
-                            if content:
-                                yield content
-                        except (json.JSONDecodeError, KeyError):
-                            continue
-    except requests.exceptions.RequestException as e:
+            for line in iter_sse_lines(response):
+                if not line.startswith(b'data: '):
+                    continue
+                event = line[6:]
+                if event == b'[DONE]':
+                    break
+                try:
+                    json_data = json_loads(event)
+                    content = json_data['choices'][0]['delta'].get('content', '')
+                    if content:
+                        yield content
+                except (ValueError, KeyError):
+                    continue
+    except httpx.HTTPError as e:
         print(f"\nError during web search: {e}")
         yield "Sorry, I couldn't perform the web search."
 
 
+# Two-stage retrieval: pull a wide candidate set (cheap - the HNSW search
+# cost barely changes between k=5 and k=20) and rerank locally so the chunks
+# that reach the prompt are both relevant and non-redundant.
+RETRIEVE_CANDIDATES = 20
+RETRIEVE_RESULTS = 5
+MMR_LAMBDA = 0.7
+
+
+def _mmr_select(query_vec, doc_vecs, k, lam=MMR_LAMBDA):
+    """Greedy Maximal Marginal Relevance over unit vectors.
+
+    Iteratively picks the document maximizing
+    lam * sim(query, doc) - (1 - lam) * max sim(doc, already selected),
+    returning the chosen indices in selection order.
+    """
+    q = np.asarray(query_vec / (np.linalg.norm(query_vec) or 1.0), dtype=np.float32)
+    norms = np.linalg.norm(doc_vecs, axis=1, keepdims=True)
+    docs = np.ascontiguousarray(doc_vecs / np.where(norms == 0, 1.0, norms), dtype=np.float32)
+    relevance = _cosine_scores(q, docs)
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(relevance)):
+        redundancy = np.max(docs @ docs[selected].T, axis=1)
+        score = lam * relevance - (1 - lam) * redundancy
+        score[selected] = -np.inf
+        selected.append(int(np.argmax(score)))
+    return selected
+
+
 def retrieve_context(query, collection):
-    """Retrieves relevant context from ChromaDB based on the query."""
+    """Retrieves relevant context from ChromaDB, MMR-reranked for diversity."""
     if not query: return ""
     query_embedding = get_ollama_embedding(query)
     if not query_embedding:
         print("  [Could not generate embedding for retrieval.]")
         return ""
-    
-    results = collection.query(query_embeddings=[query_embedding], n_results=5)
-    
+
+    results = collection.query(query_embeddings=[query_embedding],
+                               n_results=RETRIEVE_CANDIDATES,
+                               include=["documents", "embeddings"])
     if not results or not results.get('documents'): return ""
-        
-    context = "\n\n---\n\n".join(results['documents'][0])
+    docs = results['documents'][0]
+    if not docs: return ""
+
+    embeddings = results.get('embeddings')
+    if len(docs) > RETRIEVE_RESULTS and embeddings is not None and len(embeddings[0]) == len(docs):
+        order = _mmr_select(np.asarray(query_embedding, dtype=np.float32),
+                            np.asarray(embeddings[0], dtype=np.float32),
+                            RETRIEVE_RESULTS)
+        docs = [docs[i] for i in order]
+    else:
+        docs = docs[:RETRIEVE_RESULTS]
+
+    context = "\n\n---\n\n".join(docs)
     return context
 
+# Messages of history included in the router prompt. A bounded window keeps
+# the per-turn formatting cost constant and stops the router prompt from
+# growing (and slowing) with session length.
+HISTORY_WINDOW = 6
+
+
 def format_chat_history(history):
-    """Formats chat history into a simple string."""
+    """Formats the most recent chat history into a simple string."""
     if not history: return "No previous conversation."
-    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+    return "\n".join(f"{msg['role']}: {msg['content']}" for msg in list(history)[-HISTORY_WINDOW:])
+
+
+# System messages are constant; build the dicts once instead of per turn.
+RETRIEVAL_SYSTEM_MSG = {"role": "system", "content": """You are 'Nexus,' the dedicated AI Academic Counsellor for students at Sai University. Your core mission is to provide clear, accurate, and empowering guidance, helping students navigate their academic options and succeed in their studies. You act as a knowledgeable and friendly first point of contact.
+*Your Identity & Persona:*
+- *Name:* Nexus
+- *Role:* AI Academic Counsellor at Sai University
+- *Tone:* Professional, encouraging, patient, and highly supportive.
+*Your Core Directives & Reasoning Process:*
+Before you respond, always follow this internal protocol to ensure the highest quality of guidance:
+1.  *Deconstruct the Student's Need:* What is the core of their question? Are they exploring new courses, checking prerequisites, confused about eligibility, or planning their semester?
+2.  *Analyze the Official Context:* Meticulously review the provided university documents. Your answers MUST be grounded exclusively in this information. Identify all relevant details, even if they are in different sections of the context.
+3.  *Synthesize and Structure for Clarity:* Present your findings in a structured, easy-to-digest format. Use bold headings (e.g., *Course Overview:, **Eligibility Requirements:, **Key Topics:*) and bullet points to make complex information simple.
+4.  *Provide Definitive & Safe Eligibility Advice:* When asked about eligibility, quote the exact requirements from the documents. Conclude with a clear, safe summary like: "Based on the official requirements, you appear to be eligible," or "Based on the document, this course seems to require prerequisites you haven't mentioned. It's best to double-check." If the documents are unclear, state that directly.
+5.  *Address Information Gaps Transparently:* If the answer is not in the provided documents, you MUST state this clearly. For example: "I can't find the specific assessment details in the documents I have access to. For that information, reaching out to the course instructor or the department office would be the best next step." Never invent or assume information.
+6.  *Empower the Student:* Always conclude your response on a positive and helpful note. Ask if they have more questions or if there's another area you can assist with. Your goal is to make the student feel confident and well-informed.
+"""}
+
+CONVERSATION_SYSTEM_MSG = {"role": "system", "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University."}
+
+# Keep at most the last 12 messages; older turns stop inflating prompts.
+MAX_HISTORY_MESSAGES = 12
 
 def main():
     """Main function to run the RAG chatbot."""
@@ -180,7 +446,7 @@ def main():
         print(f"Error connecting to ChromaDB: {e}\nPlease ensure 'pdf_embedder.py' has been run.")
         return
 
-    chat_history = []
+    chat_history = deque(maxlen=MAX_HISTORY_MESSAGES)
     user_profile = {"major": None, "ambition": None}
     awaiting_ambition = False
 
@@ -192,7 +458,8 @@ def main():
         if not query: continue
         if query.lower() == '/exit': break
         if query.lower() == '/clear':
-            chat_history, user_profile = [], {"major": None, "ambition": None}
+            chat_history.clear()
+            user_profile = {"major": None, "ambition": None}
             awaiting_ambition = False
             print("\n[Chat history and user profile cleared.]")
             continue
@@ -225,31 +492,27 @@ def main():
 
             elif intent == 'retrieval':
                 print("  [Performing retrieval...]")
-                context = retrieve_context(routing_result["query"], collection)
-                system_prompt = """You are 'Nexus,' the dedicated AI Academic Counsellor for students at Sai University. Your core mission is to provide clear, accurate, and empowering guidance, helping students navigate their academic options and succeed in their studies. You act as a knowledgeable and friendly first point of contact.
-*Your Identity & Persona:*
-- *Name:* Nexus
-- *Role:* AI Academic Counsellor at Sai University
-- *Tone:* Professional, encouraging, patient, and highly supportive.
-*Your Core Directives & Reasoning Process:*
-Before you respond, always follow this internal protocol to ensure the highest quality of guidance:
-1.  *Deconstruct the Student's Need:* What is the core of their question? Are they exploring new courses, checking prerequisites, confused about eligibility, or planning their semester?
-2.  *Analyze the Official Context:* Meticulously review the provided university documents. Your answers MUST be grounded exclusively in this information. Identify all relevant details, even if they are in different sections of the context.
-3.  *Synthesize and Structure for Clarity:* Present your findings in a structured, easy-to-digest format. Use bold headings (e.g., *Course Overview:, **Eligibility Requirements:, **Key Topics:*) and bullet points to make complex information simple.
-4.  *Provide Definitive & Safe Eligibility Advice:* When asked about eligibility, quote the exact requirements from the documents. Conclude with a clear, safe summary like: "Based on the official requirements, you appear to be eligible," or "Based on the document, this course seems to require prerequisites you haven't mentioned. It's best to double-check." If the documents are unclear, state that directly.
-5.  *Address Information Gaps Transparently:* If the answer is not in the provided documents, you MUST state this clearly. For example: "I can't find the specific assessment details in the documents I have access to. For that information, reaching out to the course instructor or the department office would be the best next step." Never invent or assume information.
-6.  *Empower the Student:* Always conclude your response on a positive and helpful note. Ask if they have more questions or if there's another area you can assist with. Your goal is to make the student feel confident and well-informed.
-"""
-                user_prompt_with_context = f"""Context from university documents:\n---\n{context or "No context was found for this query."}\n---\nBased on the context above and our prior conversation, please answer my last question: "{query}" """
-                messages_for_api = [{"role": "system", "content": system_prompt}] + chat_history + [{"role": "user", "content": user_prompt_with_context}]
-                for chunk in stream_ollama_chat_response(GENERATION_MODEL, messages_for_api):
-                    print(chunk, end="", flush=True)
-                    final_response_parts.append(chunk)
+                search_query = routing_result["query"]
+                query_embedding = get_ollama_embedding(search_query) if search_query else None
+                cached_answer = semantic_cache_lookup(query_embedding)
+                if cached_answer is not None:
+                    print("  [Semantic cache hit - reusing a previous answer.]")
+                    print(cached_answer, end="", flush=True)
+                    final_response_parts.append(cached_answer)
+                else:
+                    context = retrieve_context(search_query, collection)
+                    user_prompt_with_context = f"""Context from university documents:\n---\n{context or "No context was found for this query."}\n---\nBased on the context above and our prior conversation, please answer my last question: "{query}" """
+                    messages_for_api = [RETRIEVAL_SYSTEM_MSG, *chat_history, {"role": "user", "content": user_prompt_with_context}]
+                    answer_parts = []
+                    for chunk in stream_ollama_chat_response(GENERATION_MODEL, messages_for_api):
+                        print(chunk, end="", flush=True)
+                        answer_parts.append(chunk)
+                    final_response_parts.extend(answer_parts)
+                    semantic_cache_store(query_embedding, "".join(answer_parts))
 
             else: # 'conversation'
                 print("  [Generating conversational response...]")
-                persona_prefix = {"role": "system", "content": "You are Nexus, a friendly and helpful AI academic counsellor for Sai University."}
-                messages_for_api = [persona_prefix] + chat_history + [{"role": "user", "content": query}]
+                messages_for_api = [CONVERSATION_SYSTEM_MSG, *chat_history, {"role": "user", "content": query}]
                 for chunk in stream_ollama_chat_response(GENERATION_MODEL, messages_for_api):
                     print(chunk, end="", flush=True)
                     final_response_parts.append(chunk)
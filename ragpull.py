@@ -1,9 +1,21 @@
 import chromadb
-import requests
-import json
+import hashlib
+import httpx
 import os
+import sqlite3
+
+import numpy as np
 from pypdf import PdfReader
 from tqdm import tqdm
+
+from fastjson import json_dumps
+
+try:
+    # PDFium-backed extraction is several times faster than pypdf's pure
+    # Python path; fall back to pypdf on minimal installs.
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Configuration ---
@@ -13,19 +25,84 @@ PDF_FILE_PATH = ""
 
 # Ollama API configuration
 OLLAMA_ENDPOINT = "http://localhost:11434/api/embeddings"
+OLLAMA_BATCH_ENDPOINT = "http://localhost:11434/api/embed"
 OLLAMA_MODEL = "nomic-embed-text:latest"
 
-# ChromaDB configuration
+# Number of chunks sent per /api/embed request; one roundtrip per batch
+# instead of one per chunk.
+EMBED_BATCH_SIZE = 64
+
+# Concurrent embedding requests in flight. The client side is I/O-bound;
+# tune up for a remote Ollama, down for a struggling local one.
+EMBED_WORKERS = 4
+
+# ChromaDB configuration. When CHROMA_SERVER_HOST is set (a server started
+# with `chroma run --path ./chroma_db --port 8000`), writes go over HTTP to
+# that server instead of the in-process PersistentClient.
 CHROMA_DB_PATH = "./chroma_db"
 COLLECTION_NAME = "pdf_embeddings"
+CHROMA_SERVER_HOST = os.getenv("CHROMA_SERVER_HOST", "")
+CHROMA_SERVER_PORT = int(os.getenv("CHROMA_SERVER_PORT", "8000"))
+
+# Persistent embedding cache: chunk text is deterministic, so re-running the
+# pipeline on an unchanged PDF becomes a pure SQLite read instead of N
+# embedding API calls. Embeddings are stored int8-quantized with a
+# per-vector scale (1 byte/dim instead of 4); they are dequantized to
+# float32 before reaching Chroma, whose L2 index expects full-scale floats.
+EMBEDDING_CACHE_PATH = "./embedding_cache.sqlite"
+
+# Rows per collection.add call; bounds the size of each Chroma write
+# transaction instead of handing it the whole corpus at once.
+CHROMA_ADD_BATCH_SIZE = 512
+
+
+# Shared HTTP client: HTTP/2 multiplexing lets the router call, streaming
+# generation and concurrent embedding requests share one connection.
+CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+    timeout=httpx.Timeout(300.0, connect=10.0),
+)
+
+# The model field of the embedding payloads never changes; serialize it once
+# and splice the dynamic part in as pre-escaped JSON bytes per call.
+_PAYLOAD_PREFIX = json_dumps({"model": OLLAMA_MODEL})[:-1]
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 # Text chunking configuration
 CHUNK_SIZE = 1000  # Size of each text chunk in characters
 CHUNK_OVERLAP = 200 # Number of characters to overlap between chunks
 
+def _extract_page_range(pdf_path, start, end):
+    """Extracts text for pages [start, end) with a private PdfReader.
+
+    Each worker opens its own reader: pypdf readers resolve objects lazily
+    from a shared stream and are not safe to share across threads.
+    """
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _extract_with_pdfium(pdf_path):
+    """Extracts all page text with PDFium.
+
+    PDFium is C-backed and much faster per page than pypdf, but it is not
+    thread-safe, so pages are walked sequentially.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        pages_text = []
+        for i in tqdm(range(len(pdf)), desc="Extracting pages"):
+            pages_text.append(pdf[i].get_textpage().get_text_range() or "")
+        return "".join(pages_text)
+    finally:
+        pdf.close()
+
+
 def extract_text_from_pdf(pdf_path):
     """
-    Extracts text from all pages of a PDF file.
+    Extracts text from all pages of a PDF file - via PDFium when available,
+    otherwise with pypdf split across worker threads.
 
     Args:
         pdf_path (str): The path to the PDF file.
@@ -35,10 +112,25 @@ def extract_text_from_pdf(pdf_path):
     """
     print(f"Reading PDF: {pdf_path}")
     try:
-        reader = PdfReader(pdf_path)
-        full_text = ""
-        for page in tqdm(reader.pages, desc="Extracting pages"):
-            full_text += page.extract_text() or ""
+        if pdfium is not None:
+            full_text = _extract_with_pdfium(pdf_path)
+            print(f"Successfully extracted {len(full_text)} characters from the PDF.")
+            return full_text
+        page_count = len(PdfReader(pdf_path).pages)
+        if not page_count:
+            return ""
+        workers = min(os.cpu_count() or 1, page_count)
+        span = -(-page_count // workers)  # ceil division
+        ranges = [(start, min(start + span, page_count)) for start in range(0, page_count, span)]
+        results = [None] * len(ranges)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_extract_page_range, pdf_path, start, end): index
+                for index, (start, end) in enumerate(ranges)
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting pages"):
+                results[futures[future]] = future.result()
+        full_text = "".join(text for pages_text in results for text in pages_text)
         print(f"Successfully extracted {len(full_text)} characters from the PDF.")
         return full_text
     except FileNotFoundError:
@@ -62,14 +154,23 @@ def chunk_text(text, chunk_size, chunk_overlap):
     """
     if not text:
         return []
-        
+
+    # The (start, end) pairs are an arithmetic progression; compute them in
+    # one vectorized step instead of a Python loop.
+    step = chunk_size - chunk_overlap
+    starts = np.arange(0, len(text), step)
+    ends = np.minimum(starts + chunk_size, len(text))
+
     chunks = []
-    start_index = 0
-    while start_index < len(text):
-        end_index = start_index + chunk_size
-        chunks.append(text[start_index:end_index])
-        start_index += chunk_size - chunk_overlap
-    
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if end < len(text):
+            # Snap the cut to the nearest whitespace within 50 chars so a
+            # word is not split across chunks.
+            snap = text.rfind(" ", max(start, end - 50), end)
+            if snap > start:
+                end = snap
+        chunks.append(text[start:end])
+
     print(f"Text split into {len(chunks)} chunks.")
     return chunks
 
@@ -84,22 +185,70 @@ def get_ollama_embedding(text_chunk):
         list[float]: The generated embedding vector, or None if an error occurs.
     """
     try:
-        payload = {
-            "model": OLLAMA_MODEL,
-            "prompt": text_chunk
-        }
-        response = requests.post(OLLAMA_ENDPOINT, json=payload)
+        body = _PAYLOAD_PREFIX + b',"prompt":' + json_dumps(text_chunk) + b'}'
+        response = CLIENT.post(OLLAMA_ENDPOINT, content=body, headers=JSON_HEADERS, timeout=60)
         response.raise_for_status() # Raises an HTTPError for bad responses
         response_json = response.json()
         return response_json.get("embedding")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Don't print for every failure in sequential mode, just return None
         return None
 
+def get_ollama_embeddings_batch(text_chunks):
+    """
+    Generates embeddings for several text chunks in one Ollama API call.
+
+    Args:
+        text_chunks (list[str]): The texts to embed.
+
+    Returns:
+        list[list[float]]: One embedding per chunk, or None if the batched
+        endpoint is unavailable (callers should fall back to per-chunk calls).
+    """
+    try:
+        body = _PAYLOAD_PREFIX + b',"input":' + json_dumps(text_chunks) + b'}'
+        response = CLIENT.post(OLLAMA_BATCH_ENDPOINT, content=body, headers=JSON_HEADERS, timeout=60)
+        response.raise_for_status()
+        embeddings = response.json().get("embeddings")
+        if embeddings is None or len(embeddings) != len(text_chunks):
+            return None
+        return embeddings
+    except httpx.HTTPError:
+        return None
+
+
+def _open_embedding_cache():
+    db = sqlite3.connect(EMBEDDING_CACHE_PATH)
+    db.execute("CREATE TABLE IF NOT EXISTS cache (sha TEXT PRIMARY KEY, embedding BLOB, scale REAL)")
+    try:
+        db.execute("ALTER TABLE cache ADD COLUMN scale REAL")
+    except sqlite3.OperationalError:
+        pass  # column already present
+    return db
+
+
+def _quantize_embedding(embedding):
+    """Returns (int8 blob, scale) for a float embedding."""
+    vec = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.max(np.abs(vec))) / 127.0 or 1.0
+    quantized = np.round(vec / scale).astype(np.int8)
+    return quantized.tobytes(), scale
+
+
+def _dequantize_embedding(blob, scale):
+    if scale is None:
+        # Row from before quantization: raw float32 bytes.
+        return np.frombuffer(blob, dtype=np.float32).tolist()
+    return (np.frombuffer(blob, dtype=np.int8).astype(np.float32) * scale).tolist()
+
+
 def store_chunks_in_chromadb(chunks, collection):
     """
-    Generates embeddings for a list of text chunks sequentially and stores them in ChromaDB.
-    
+    Generates embeddings for a list of text chunks in batches and stores them in ChromaDB.
+
+    Chunks whose SHA-256 is already in the persistent embedding cache are
+    served from SQLite; only the misses hit the embedding API.
+
     Args:
         chunks (list[str]): The list of text chunks.
         collection: The ChromaDB collection object.
@@ -107,32 +256,95 @@ def store_chunks_in_chromadb(chunks, collection):
     if not chunks:
         print("No chunks to store.")
         return
-        
+
     print(f"Storing {len(chunks)} chunks in ChromaDB collection '{COLLECTION_NAME}'...")
-    
-    # Prepare lists to hold all data for a single batch add operation
-    ids_to_add = []
-    embeddings_to_add = []
-    documents_to_add = []
-
-    # Process chunks sequentially to avoid overloading the Ollama server
-    for i, chunk in enumerate(tqdm(chunks, desc="Generating embeddings")):
-        embedding = get_ollama_embedding(chunk)
-        if embedding:
-            ids_to_add.append(str(i))
-            embeddings_to_add.append(embedding)
-            documents_to_add.append(chunk)
-        else:
-            print(f"\nWarning: Could not generate embedding for chunk {i}. Skipping.")
-
-    # Add all collected data to ChromaDB in a single batch
-    if documents_to_add:
-        collection.add(
-            ids=ids_to_add,
-            embeddings=embeddings_to_add,
-            documents=documents_to_add
-        )
-    
+
+    db = _open_embedding_cache()
+    shas = [hashlib.sha256(chunk.encode("utf-8")).hexdigest() for chunk in chunks]
+    embeddings = [None] * len(chunks)
+
+    # 1) Serve what we can from the cache.
+    known = {}
+    unique_shas = list(dict.fromkeys(shas))
+    for start in range(0, len(unique_shas), 500):
+        window = unique_shas[start:start + 500]
+        placeholders = ",".join("?" * len(window))
+        known.update(
+            (sha, (blob, scale)) for sha, blob, scale in db.execute(
+                f"SELECT sha, embedding, scale FROM cache WHERE sha IN ({placeholders})", window))
+    hits = 0
+    for i, sha in enumerate(shas):
+        row = known.get(sha)
+        if row is not None:
+            embeddings[i] = _dequantize_embedding(*row)
+            hits += 1
+    if hits:
+        print(f"Reusing {hits} cached embeddings from '{EMBEDDING_CACHE_PATH}'.")
+
+    # 2) Embed the misses in parallel batches against /api/embed, writing
+    # completed rows to Chroma on a dedicated writer thread so the next
+    # batch embeds while the previous one is being persisted. Any batch the
+    # server rejects falls back to per-chunk calls.
+    writer = ThreadPoolExecutor(max_workers=1)
+    add_futures = []
+    pending_ids, pending_embeddings, pending_documents = [], [], []
+
+    def flush_rows():
+        nonlocal pending_ids, pending_embeddings, pending_documents
+        if not pending_ids:
+            return
+        add_futures.append(writer.submit(
+            collection.add,
+            ids=pending_ids, embeddings=pending_embeddings, documents=pending_documents))
+        pending_ids, pending_embeddings, pending_documents = [], [], []
+
+    def queue_row(i, embedding):
+        pending_ids.append(str(i))
+        pending_embeddings.append(embedding)
+        pending_documents.append(chunks[i])
+        if len(pending_ids) >= CHROMA_ADD_BATCH_SIZE:
+            flush_rows()
+
+    # Cache hits can start flowing to the writer immediately.
+    for i, embedding in enumerate(embeddings):
+        if embedding is not None:
+            queue_row(i, embedding)
+
+    miss_indices = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    batch_starts = list(range(0, len(miss_indices), EMBED_BATCH_SIZE))
+    new_rows = []
+    if batch_starts:
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+            futures = {
+                executor.submit(get_ollama_embeddings_batch,
+                                [chunks[j] for j in miss_indices[start:start + EMBED_BATCH_SIZE]]): start
+                for start in batch_starts
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Generating embeddings"):
+                start = futures[future]
+                indices = miss_indices[start:start + EMBED_BATCH_SIZE]
+                batch_embeddings = future.result()
+                if batch_embeddings is None:
+                    batch_embeddings = [get_ollama_embedding(chunks[j]) for j in indices]
+                for j, embedding in zip(indices, batch_embeddings):
+                    if embedding:
+                        blob, scale = _quantize_embedding(embedding)
+                        new_rows.append((shas[j], blob, scale))
+                        queue_row(j, embedding)
+                    else:
+                        print(f"\nWarning: Could not generate embedding for chunk {j}. Skipping.")
+
+    flush_rows()
+    for future in add_futures:
+        future.result()  # surface any writer-side failure
+    writer.shutdown()
+
+    # 3) Persist the new embeddings in one transaction.
+    if new_rows:
+        with db:
+            db.executemany("INSERT OR REPLACE INTO cache (sha, embedding, scale) VALUES (?, ?, ?)", new_rows)
+    db.close()
+
     count = collection.count()
     print(f"\nSuccessfully stored {count} embeddings in the collection.")
 
@@ -161,10 +373,15 @@ def main():
         print("Could not generate any text chunks.")
         return
         
-    # 4. Initialize ChromaDB
-    print(f"Initializing ChromaDB client at '{CHROMA_DB_PATH}'...")
+    # 4. Initialize ChromaDB (HTTP client when a server is configured, so
+    # writes leave the ingest process entirely)
     try:
-        client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+        if CHROMA_SERVER_HOST:
+            print(f"Connecting to Chroma server at {CHROMA_SERVER_HOST}:{CHROMA_SERVER_PORT}...")
+            client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT)
+        else:
+            print(f"Initializing ChromaDB client at '{CHROMA_DB_PATH}'...")
+            client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
         collection = client.get_or_create_collection(name=COLLECTION_NAME)
     except Exception as e:
         print(f"Failed to initialize ChromaDB: {e}")
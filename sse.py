@@ -0,0 +1,53 @@
+import time
+
+
+def coalesce(gen, max_bytes=4096, max_ms=20):
+    """Batches a text-chunk generator into roughly max_bytes-sized writes.
+
+    One upstream SSE event is often a single token, and each yield costs the
+    WSGI layer a send() syscall. Accumulate chunks until the size threshold
+    or a short deadline is reached; the deadline is checked as chunks arrive,
+    so a still-streaming upstream flushes every ~max_ms without a timer
+    thread. Yields UTF-8 bytes, as required by responses that bypass Flask's
+    response transformation (direct_passthrough).
+    """
+    buf = bytearray()
+    deadline = None
+    for chunk in gen:
+        buf += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        now = time.monotonic()
+        if deadline is None:
+            deadline = now + max_ms / 1000.0
+        if len(buf) >= max_bytes or now >= deadline:
+            yield bytes(buf)
+            buf.clear()
+            deadline = None
+    if buf:
+        yield bytes(buf)
+
+
+def iter_sse_lines(resp):
+    """Yields complete lines (as bytes, no trailing newline) from an httpx
+    streaming response.
+
+    Reads 4KB byte chunks into a single growing buffer and splits on
+    newlines, instead of paying iter_lines' per-line buffering and UTF-8
+    decode on every streamed token. iter_bytes (not iter_raw) is used so
+    httpx still reverses any Content-Encoding the server applied - the
+    clients advertise gzip/deflate, and a compressed stream read raw would
+    be undecodable garbage. Works for both SSE ("data: ..." framed) and
+    NDJSON (Ollama) upstreams; blank keep-alive lines are dropped.
+    """
+    buf = bytearray()
+    for chunk in resp.iter_bytes(chunk_size=4096):
+        buf += chunk
+        while True:
+            nl = buf.find(b"\n")
+            if nl < 0:
+                break
+            line = bytes(buf[:nl]).rstrip(b"\r")
+            del buf[:nl + 1]
+            if line:
+                yield line
+    if buf:
+        yield bytes(buf)
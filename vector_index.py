@@ -0,0 +1,108 @@
+import io
+import os
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# --- Index configuration ---
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+
+def assemble_context(docs):
+    """Joins retrieved documents into a single context block.
+
+    Writes each document and separator into one growing buffer, so assembly
+    is a single allocation regardless of document count.
+    """
+    buf = io.StringIO()
+    for i, doc in enumerate(docs):
+        if i:
+            buf.write(CONTEXT_SEPARATOR)
+        buf.write(doc)
+    return buf.getvalue()
+
+
+class VectorIndex:
+    """FAISS HNSW index over a Chroma collection's embeddings.
+
+    Chroma stays the document store; nearest-neighbour queries go through
+    FAISS instead of collection.query(), avoiding Chroma's per-query
+    SQLite/pickle overhead. Vectors are L2-normalized on both sides so the
+    inner-product metric behaves as cosine similarity regardless of
+    embedding norms, and stored with 8-bit scalar quantization, which cuts
+    the index to a quarter of fp32 and keeps the inner-product kernel in
+    int8-friendly SIMD. The index is persisted next to the database and
+    rebuilt whenever the collection size (or index format) no longer
+    matches the saved file. Falls back cleanly (ready == False) when faiss
+    is not installed or the collection is empty.
+    """
+
+    def __init__(self, collection, index_path):
+        self._docs = []
+        self._index = None
+        if faiss is None or collection is None:
+            return
+        try:
+            data = collection.get(include=["embeddings", "documents"])
+            embeddings = data.get("embeddings")
+            self._docs = data.get("documents") or []
+            if embeddings is None or len(embeddings) == 0 or not self._docs:
+                return
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            faiss.normalize_L2(embeddings)
+            if os.path.exists(index_path):
+                try:
+                    index = faiss.read_index(index_path)
+                    # downcast_index returns a non-owning view: use it for the
+                    # format check only and keep the owning object.
+                    if (index.ntotal == len(self._docs)
+                            and isinstance(faiss.downcast_index(index), faiss.IndexHNSWSQ)):
+                        self._index = index
+                        return
+                except Exception:
+                    pass  # unreadable or pre-quantization index file; rebuild below
+            index = faiss.IndexHNSWSQ(embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit,
+                                      HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.train(embeddings)
+            index.add(embeddings)
+            faiss.write_index(index, index_path)
+            self._index = index
+        except Exception as e:
+            print(f"Could not build FAISS index, falling back to Chroma queries: {e}")
+            self._docs = []
+            self._index = None
+
+    @property
+    def ready(self):
+        return self._index is not None
+
+    def extend(self, embeddings, documents):
+        """Adds rows written to Chroma at runtime to the live index.
+
+        Keeps search results consistent with the collection between
+        restarts; the persisted file goes stale and is rebuilt by the size
+        check on next startup. Returns False when there is no index to
+        extend (caller should rebuild from the collection instead).
+        """
+        if self._index is None:
+            return False
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        self._index.add(vectors)
+        self._docs.extend(documents)
+        return True
+
+    def search(self, query_embedding, n_results=5):
+        """Returns the documents nearest to the query embedding."""
+        query = np.ascontiguousarray([query_embedding], dtype=np.float32)
+        faiss.normalize_L2(query)
+        _, ids = self._index.search(query, n_results)
+        return [self._docs[i] for i in ids[0] if i >= 0]
@@ -0,0 +1,14 @@
+"""Gunicorn entrypoint.
+
+The Werkzeug dev server handles one request at a time, so a single
+streaming /chat call blocks every other client for the whole generation.
+Serve with gevent workers instead:
+
+    gunicorn --worker-class gevent --workers 4 --worker-connections 128 wsgi:app
+
+(newrag_backend can be served the same way: `... newrag_backend:app`.)
+"""
+from app import app
+
+if __name__ == "__main__":
+    app.run()